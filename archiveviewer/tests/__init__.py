@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013, 2015, 2019 MATOBA Akihiro <matobaa+trac-hacks@gmail.com>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+import unittest
+
+from archiveviewer.tests import test_zip
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(test_zip.test_suite())
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
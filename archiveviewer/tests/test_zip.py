@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013, 2015, 2019 MATOBA Akihiro <matobaa+trac-hacks@gmail.com>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+import io
+import os
+import threading
+import time
+import unittest
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+from trac.attachment import Attachment
+from trac.resource import Resource, ResourceNotFound
+from trac.test import EnvironmentStub, MockRequest, mkdtemp
+from trac.ticket.model import Ticket
+from trac.web.api import RequestDone
+from trac.wiki.model import WikiPage
+
+from archiveviewer.zip import ZipIndex, ZipRenderer, _LazyZipEntry, \
+    _LRUCache, _open_stored, _parse_range
+
+
+_PNG = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + b'\x00' * 64
+
+
+def _make_zip(stored):
+    buf = io.BytesIO()
+    with ZipFile(buf, 'w') as zipfile:
+        zipfile.writestr('deflated.txt', b'text ' * 200, ZIP_DEFLATED)
+        zipfile.writestr('stored.bin', stored, ZIP_STORED)
+        zipfile.writestr('image.png', _PNG, ZIP_STORED)
+    return buf.getvalue()
+
+
+class _SendfileWrapper(object):
+    """`wsgi.file_wrapper` sending like gunicorn does: from the current
+    offset of the descriptor, as many bytes as the Content-Length."""
+
+    def __init__(self, filelike, blksize):
+        self.filelike = filelike
+
+    def send(self, length):
+        fd = self.filelike.fileno()
+        return os.pread(fd, length, os.lseek(fd, 0, os.SEEK_CUR))
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_maxsize(self):
+        cache = _LRUCache(2)
+        for i in range(3):
+            cache.set(i, i)
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(1, cache.get(1))
+        cache.set(3, 3)
+        self.assertEqual(1, cache.get(1))
+        self.assertIsNone(cache.get(2))
+
+    def test_sizeof(self):
+        cache = _LRUCache(10, len)
+        cache.set('a', b'12345')
+        cache.set('b', b'1234')
+        cache.set('c', b'12')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(b'1234', cache.get('b'))
+        self.assertEqual(b'12', cache.pop('c'))
+        cache.set('d', b'123456')
+        self.assertEqual(b'1234', cache.get('b'))
+
+    def test_index_cache_entries(self):
+        zr = ZipRenderer(EnvironmentStub())
+        index = ZipIndex([None] * 150000, {})
+        zr._zip_index_cache.set('a', index)
+        zr._zip_index_cache.set('b', index)
+        self.assertIsNone(zr._zip_index_cache.get('a'))
+        self.assertIs(index, zr._zip_index_cache.get('b'))
+
+
+class RangeFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.stored = bytes(bytearray(range(256))) * 64
+        self.content = _make_zip(self.stored)
+        self.path = os.path.join(self.dir, 'test.zip')
+        with open(self.path, 'wb') as f:
+            f.write(self.content)
+        self.fileobj = open(self.path, 'rb')
+        self.zipfile = ZipFile(self.fileobj)
+        self.offset = self.content.index(self.stored)
+
+    def tearDown(self):
+        self.fileobj.close()
+        os.remove(self.path)
+        os.rmdir(self.dir)
+
+    def _open(self, name):
+        return _open_stored(self.fileobj, self.zipfile.getinfo(name))
+
+    def test_deflated(self):
+        self.assertIsNone(self._open('deflated.txt'))
+
+    def test_descriptor_offset(self):
+        rangefile = self._open('stored.bin')
+        fd = rangefile.fileno()
+        self.assertEqual(self.offset, os.lseek(fd, 0, os.SEEK_CUR))
+        self.assertEqual(self.offset, rangefile.tell())
+        self.assertEqual(self.stored[:512], rangefile.peek(512))
+        self.assertEqual(self.offset, os.lseek(fd, 0, os.SEEK_CUR))
+
+    def test_read(self):
+        rangefile = self._open('stored.bin')
+        self.assertEqual(self.stored[:100], rangefile.read(100))
+        self.assertEqual(self.offset + 100, rangefile.tell())
+        self.assertEqual(self.stored[100:], rangefile.read())
+        self.assertEqual(b'', rangefile.read())
+
+
+class ParseRangeTestCase(unittest.TestCase):
+
+    def test_missing(self):
+        self.assertIsNone(_parse_range(None, 100))
+        self.assertIsNone(_parse_range('', 100))
+
+    def test_first_last(self):
+        self.assertEqual((0, 9), _parse_range('bytes=0-9', 100))
+        self.assertEqual((90, 99), _parse_range('bytes=90-200', 100))
+
+    def test_open_ended(self):
+        self.assertEqual((5, 99), _parse_range('bytes=5-', 100))
+
+    def test_suffix(self):
+        self.assertEqual((97, 99), _parse_range('bytes=-3', 100))
+        self.assertEqual((0, 99), _parse_range('bytes=-300', 100))
+
+    def test_ignored(self):
+        self.assertIsNone(_parse_range('bytes=100-', 100))
+        self.assertIsNone(_parse_range('bytes=5-2', 100))
+        self.assertIsNone(_parse_range('bytes=-0', 100))
+        self.assertIsNone(_parse_range('bytes=0-1,3-4', 100))
+        self.assertIsNone(_parse_range('items=0-9', 100))
+
+
+class RawDownloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'archiveviewer.*'],
+                                   path=mkdtemp())
+        page = WikiPage(self.env, 'WikiStart')
+        page.text = 'content'
+        page.save('admin', 'comment')
+        self.stored = os.urandom(100000)
+        content = _make_zip(self.stored)
+        attachment = Attachment(self.env, 'wiki', 'WikiStart')
+        attachment.insert('test.zip', io.BytesIO(content), len(content))
+        self.zr = ZipRenderer(self.env)
+
+    def tearDown(self):
+        self.env.reset_db_and_disk()
+
+    def _request(self, name, archive='test.zip', **headers):
+        req = MockRequest(self.env, path_info=
+                          '/raw-zip/attachment/wiki/WikiStart/%s!/%s'
+                          % (archive, name))
+        req.environ['wsgi.file_wrapper'] = _SendfileWrapper
+        for header, value in headers.items():
+            req.environ['HTTP_' + header.upper()] = value
+        self.assertTrue(self.zr.match_request(req))
+        self.assertRaises(RequestDone, self.zr.process_request, req)
+        self.addCleanup(req._response.filelike.close)
+        return req
+
+    def test_stored_sendfile(self):
+        req = self._request('stored.bin')
+        self.assertEqual(['200 Ok'], req.status_sent)
+        length = int(req.headers_sent['Content-Length'])
+        self.assertEqual(len(self.stored), length)
+        self.assertEqual(self.stored, req._response.send(length))
+
+    def test_stored_range(self):
+        req = self._request('stored.bin', range='bytes=1000-1999')
+        self.assertEqual(['206 Partial Content'], req.status_sent)
+        self.assertEqual('bytes 1000-1999/%d' % len(self.stored),
+                         req.headers_sent['Content-Range'])
+        length = int(req.headers_sent['Content-Length'])
+        self.assertEqual(1000, length)
+        self.assertEqual(self.stored[1000:2000], req._response.send(length))
+
+    def test_stored_range_if_range(self):
+        req = self._request('stored.bin')
+        last_modified = req.headers_sent['Last-Modified']
+        req = self._request('stored.bin', range='bytes=1000-1999',
+                            if_range=last_modified)
+        self.assertEqual(['206 Partial Content'], req.status_sent)
+        req = self._request('stored.bin', range='bytes=1000-1999',
+                            if_range='Thu, 01 Jan 1970 00:00:00 GMT')
+        self.assertEqual(['200 Ok'], req.status_sent)
+        self.assertNotIn('Content-Range', req.headers_sent)
+        length = int(req.headers_sent['Content-Length'])
+        self.assertEqual(self.stored, req._response.send(length))
+
+    def test_binary_content_type(self):
+        req = self._request('image.png')
+        self.assertEqual('image/png', req.headers_sent['Content-Type'])
+
+    def test_text_content_type(self):
+        req = self._request('deflated.txt')
+        self.assertEqual('text/plain; charset=utf-8',
+                         req.headers_sent['Content-Type'])
+
+    def test_not_zip(self):
+        content = os.urandom(100000).replace(b'PK', b'pk')
+        attachment = Attachment(self.env, 'wiki', 'WikiStart')
+        attachment.insert('junk.zip', io.BytesIO(content), len(content))
+        try:
+            self._request('stored.bin', archive='junk.zip')
+        except ResourceNotFound as e:
+            self.assertEqual("'junk.zip' is not a zip archive.",
+                             e.message)
+        else:
+            self.fail('ResourceNotFound not raised')
+
+    def test_deflated_range(self):
+        req = self._request('deflated.txt', range='bytes=0-9')
+        self.assertEqual(['200 Ok'], req.status_sent)
+        self.assertNotIn('Accept-Ranges', req.headers_sent)
+        self.assertEqual(b'text ' * 200, req._response.filelike.read())
+
+
+def _make_nested_zip(text):
+    inner = io.BytesIO()
+    with ZipFile(inner, 'w') as zipfile:
+        zipfile.writestr('dir/c.txt', text, ZIP_DEFLATED)
+    outer = io.BytesIO()
+    with ZipFile(outer, 'w') as zipfile:
+        zipfile.writestr('inner.zip', inner.getvalue(), ZIP_DEFLATED)
+    return outer.getvalue()
+
+
+class NestedArchiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'archiveviewer.*'],
+                                   path=mkdtemp())
+        page = WikiPage(self.env, 'WikiStart')
+        page.text = 'content'
+        page.save('admin', 'comment')
+        self._insert(b'first text')
+        self.zr = ZipRenderer(self.env)
+
+    def tearDown(self):
+        self.env.reset_db_and_disk()
+
+    def _insert(self, text):
+        content = _make_nested_zip(text)
+        attachment = Attachment(self.env, 'wiki', 'WikiStart')
+        attachment.insert('outer.zip', io.BytesIO(content), len(content))
+
+    def _request(self, name):
+        req = MockRequest(self.env, path_info=
+                          '/raw-zip/attachment/wiki/WikiStart/outer.zip!/' +
+                          name)
+        req.environ['wsgi.file_wrapper'] = _SendfileWrapper
+        self.assertTrue(self.zr.match_request(req))
+        self.assertRaises(RequestDone, self.zr.process_request, req)
+        filelike = req._response.filelike
+        self.addCleanup(filelike.close)
+        return filelike.read()
+
+    def test_two_levels(self):
+        self.assertEqual(b'first text', self._request('inner.zip!/dir/c.txt'))
+
+    def test_missing_inner_member(self):
+        self.assertRaises(ResourceNotFound, self._request,
+                          'inner.zip!/dir/missing.txt')
+        self.assertRaises(ResourceNotFound, self._request,
+                          'missing.zip!/dir/c.txt')
+
+    def test_member_not_zip(self):
+        try:
+            self._request('inner.zip!/dir/c.txt!/d.txt')
+        except ResourceNotFound as e:
+            self.assertEqual("'dir/c.txt' is not a zip archive.", e.message)
+        else:
+            self.fail('ResourceNotFound not raised')
+
+    def test_replaced_attachment(self):
+        self.assertEqual(b'first text', self._request('inner.zip!/dir/c.txt'))
+        Attachment(self.env, 'wiki', 'WikiStart', 'outer.zip').delete()
+        self._insert(b'replaced with a longer text')
+        self.assertEqual(b'replaced with a longer text',
+                         self._request('inner.zip!/dir/c.txt'))
+
+    def test_inflated_once(self):
+        opened = []
+        real_open = _LazyZipEntry.open
+
+        def counting_open(entry):
+            opened.append(entry.zipinfo.filename)
+            return real_open(entry)
+        _LazyZipEntry.open = counting_open
+        self.addCleanup(setattr, _LazyZipEntry, 'open', real_open)
+        for i in range(3):
+            self.assertEqual(b'first text',
+                             self._request('inner.zip!/dir/c.txt'))
+        self.assertEqual(1, opened.count('inner.zip'))
+        self.assertEqual(3, opened.count('dir/c.txt'))
+
+
+class PrefetchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'archiveviewer.*'],
+                                   path=mkdtemp())
+        page = WikiPage(self.env, 'WikiStart')
+        page.text = 'content'
+        page.save('admin', 'comment')
+        buf = io.BytesIO()
+        with ZipFile(buf, 'w') as zipfile:
+            for i in range(100):
+                zipfile.writestr('file%d.txt' % i, b'', ZIP_STORED)
+        content = buf.getvalue()
+        attachment = Attachment(self.env, 'wiki', 'WikiStart')
+        attachment.insert('test.zip', io.BytesIO(content), len(content))
+        self.zr = ZipRenderer(self.env)
+        self.parses = 0
+        real_get_contents = ZipFile._RealGetContents
+
+        def counting_get_contents(zipfile):
+            # slow enough for the request to catch up with the prefetch
+            self.parses += 1
+            time.sleep(0.2)
+            real_get_contents(zipfile)
+        ZipFile._RealGetContents = counting_get_contents
+        self.addCleanup(setattr, ZipFile, '_RealGetContents',
+                        real_get_contents)
+
+    def tearDown(self):
+        self.env.reset_db_and_disk()
+
+    def _request(self):
+        req = MockRequest(self.env, path_info=
+                          '/raw-zip/attachment/wiki/WikiStart/test.zip'
+                          '!/file1.txt')
+        req.environ['wsgi.file_wrapper'] = _SendfileWrapper
+        self.assertTrue(self.zr.match_request(req))
+        self.assertEqual(self.zr, self.zr.pre_process_request(req, self.zr))
+        self.assertRaises(RequestDone, self.zr.process_request, req)
+        req._response.filelike.close()
+
+    def test_parsed_once(self):
+        self._request()
+        self.assertEqual(1, self.parses)
+        threads = threading.active_count()
+        self._request()
+        self.assertEqual(1, self.parses)
+        self.assertEqual(threads, threading.active_count())
+
+
+class ResourceExistsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'archiveviewer.*'],
+                                   path=mkdtemp())
+        page = WikiPage(self.env, 'WikiStart')
+        page.text = 'content'
+        page.save('admin', 'comment')
+        self.zr = ZipRenderer(self.env)
+        self.resource = Resource('wiki', 'WikiStart') \
+                        .child('attachment', 'test.zip') \
+                        .child('zip', 'stored.bin')
+
+    def tearDown(self):
+        self.env.reset_db_and_disk()
+
+    def _insert(self, realm='wiki', id='WikiStart'):
+        content = _make_zip(b'stored')
+        attachment = Attachment(self.env, realm, id)
+        attachment.insert('test.zip', io.BytesIO(content), len(content))
+        return attachment
+
+    def test_added(self):
+        self.assertFalse(self.zr.resource_exists(self.resource))
+        self._insert()
+        self.assertTrue(self.zr.resource_exists(self.resource))
+
+    def test_added_to_ticket(self):
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'summary'
+        ticket.insert()
+        resource = ticket.resource.child('attachment', 'test.zip') \
+                                  .child('zip', 'stored.bin')
+        self.assertFalse(self.zr.resource_exists(resource))
+        self._insert('ticket', ticket.id)
+        self.assertTrue(self.zr.resource_exists(resource))
+
+    def test_deleted(self):
+        self._insert()
+        self.assertTrue(self.zr.resource_exists(self.resource))
+        Attachment(self.env, 'wiki', 'WikiStart', 'test.zip').delete()
+        self.assertFalse(self.zr.resource_exists(self.resource))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    loader = unittest.defaultTestLoader
+    suite.addTest(loader.loadTestsFromTestCase(LRUCacheTestCase))
+    suite.addTest(loader.loadTestsFromTestCase(RangeFileTestCase))
+    suite.addTest(loader.loadTestsFromTestCase(ParseRangeTestCase))
+    suite.addTest(loader.loadTestsFromTestCase(RawDownloadTestCase))
+    suite.addTest(loader.loadTestsFromTestCase(NestedArchiveTestCase))
+    suite.addTest(loader.loadTestsFromTestCase(PrefetchTestCase))
+    suite.addTest(loader.loadTestsFromTestCase(ResourceExistsTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
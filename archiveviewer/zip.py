@@ -10,17 +10,25 @@
 import os
 import re
 import io
+import shutil
+import struct
+import time
+from collections import namedtuple, OrderedDict
 from datetime import datetime
-from zipfile import ZipFile
+from tempfile import SpooledTemporaryFile
+from threading import BoundedSemaphore, Event, Lock, Thread
+from zipfile import BadZipfile, ZipFile, ZIP_STORED
 
-from trac.attachment import Attachment, AttachmentModule
+from trac.attachment import Attachment, AttachmentModule, \
+    IAttachmentChangeListener
 from trac.core import Component, implements, TracError
-from trac.mimeview.api import IHTMLPreviewRenderer, Mimeview
+from trac.mimeview.api import IHTMLPreviewRenderer, Mimeview, is_binary
 from trac.resource import get_resource_url, Resource, IResourceManager, \
     get_resource_name, ResourceNotFound
+from trac.util import lazy
 from trac.util.datefmt import http_date, to_datetime
 from trac.util.html import html as tag
-from trac.util.text import pretty_size, unicode_unquote
+from trac.util.text import pretty_size, to_unicode, unicode_unquote
 from trac.util.translation import _
 from trac.versioncontrol.api import RepositoryManager, NoSuchChangeset
 from trac.versioncontrol.web_ui.browser import BrowserModule
@@ -32,24 +40,385 @@ from trac.web.wsgi import _FileWrapper
 from trac.wiki.api import IWikiSyntaxProvider
 
 
+# Parsed central directory of an archive; ``infolist`` keeps the archive
+# order, ``name_to_info`` maps each filename to its ``ZipInfo``.
+ZipIndex = namedtuple('ZipIndex', 'infolist name_to_info')
+
+# localid:parent_realm:parent_id or localid:parent_realm:filename:realm:id
+_LINK_RE = re.compile(r'([^:]*):([^:]*):(?:([^:]*):([^:]*):(.*)|([^:]*))$')
+
+_RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+_BUFSIZE = 65536
+
+# ZipInfo objects kept by the central directory cache, over all archives
+_INDEX_CACHE_SIZE = 200000
+
+# Inflated archives nested in attachments, shared between requests
+_NESTED_CACHE_SIZE = 128 * 1024 * 1024
+_NESTED_ENTRY_SIZE = 16 * 1024 * 1024
+
+_ATTACHMENT_RE = re.compile(r'/(raw-)?zip(?:/zip)*/attachment/([^/]+)/([^!]*)/([^/!]+)(!/.+)?(@.+)?$')
+_BROWSER_RE = re.compile(r'/(raw-)?zip(?:/zip)*/(export|browser|file)/([^!]+)(!/[^@]+)?(@.+)?$')
+
+
+class _LRUCache(object):
+    """Small thread-safe mapping which drops the least recently used
+    entries once their total size exceeds `maxsize`. The size of an
+    entry is given by `sizeof(value)`, 1 by default."""
+
+    def __init__(self, maxsize, sizeof=None):
+        self.maxsize = maxsize
+        self._sizeof = sizeof or (lambda value: 1)
+        self._size = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data.pop(key)
+            self._size -= self._sizeof(value)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self._size -= self._sizeof(self._data.pop(key))
+            self._data[key] = value
+            self._size += self._sizeof(value)
+            while self._size > self.maxsize and self._data:
+                self._size -= self._sizeof(self._data.popitem(last=False)[1])
+
+
+def _parsed_path(args, realm, archive):
+    """Return what `match_request()` parsed from the request path, for
+    the later stages of the request; `segments` are the member names
+    in the `!/a.zip!/b.txt` path."""
+    name = (args['path'] or '')[2:]
+    return {'format': args['format'], 'realm': realm, 'archive': archive,
+            'segments': tuple(e.lstrip('/') for e in name.split('!'))
+                        if name else ()}
+
+
+def _file_key(fileobj):
+    """Return a cache key for `fileobj` if it is a file on disk, or
+    `None` for other streams.
+
+    Only use it for attachment files: temporary files, e.g. spooled
+    repository content, are named by their reused descriptor number.
+    """
+    try:
+        st = os.fstat(fileobj.fileno())
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+    return (fileobj.name, st.st_mtime, st.st_size)
+
+
+def _zip_index(zipfile):
+    """Return the `ZipIndex` of the open `zipfile`."""
+    return ZipIndex(zipfile.infolist(), zipfile.NameToInfo)
+
+
+class _IndexedZipFile(ZipFile):
+    """`ZipFile` taking its central directory from a `ZipIndex` instead
+    of parsing it from the file."""
+
+    def __init__(self, file, index):
+        self.index = index
+        ZipFile.__init__(self, file)
+
+    def _RealGetContents(self):
+        # called by ZipFile.__init__ in read mode
+        self.filelist = self.index.infolist
+        self.NameToInfo = self.index.name_to_info
+
+
+def _spool(fileobj, size, max_size):
+    """Copy the `size` bytes of `fileobj` into a seekable file object.
+
+    The copy is kept in memory up to `max_size` bytes, larger ones are
+    spooled to a temporary file. `fileobj` is read in 64 KiB blocks;
+    that is the default of Python 3 on most platforms already, but
+    Python 2 copies in 16 KiB blocks.
+    """
+    if size > max_size:
+        spool = SpooledTemporaryFile(max_size=max_size)
+    else:
+        spool = io.BytesIO()
+    shutil.copyfileobj(fileobj, spool, _BUFSIZE)
+    spool.seek(0)
+    return spool
+
+
+class _LazyZipEntry(object):
+    """Member `zipinfo` of the open `zipfile`; nothing is decompressed
+    until `open()` or `spool()` is called."""
+
+    def __init__(self, zipfile, zipinfo):
+        self.zipfile = zipfile
+        self.zipinfo = zipinfo
+
+    def open(self):
+        """Return a file-like object streaming the uncompressed content."""
+        return self.zipfile.open(self.zipinfo)
+
+    def spool(self, max_size):
+        """Return the uncompressed content as a seekable file object.
+
+        Entries up to `max_size` bytes are kept in memory, larger ones
+        are spooled to a temporary file.
+        """
+        fileobj = self.open()
+        try:
+            return _spool(fileobj, self.zipinfo.file_size, max_size)
+        finally:
+            fileobj.close()
+
+
+class _RangeFile(object):
+    """Read-only view of `length` bytes of the file `fileobj`, starting
+    at `offset`.
+
+    Unlike `ZipExtFile` it has a `fileno()`, which lets WSGI servers
+    implementing `wsgi.file_wrapper` send the content with sendfile(2).
+    Such servers start at the offset of the descriptor (or at `tell()`),
+    so the view reads the descriptor directly and keeps its offset at
+    the current position; the buffered `fileobj` must not be read from
+    while the view is in use.
+    """
+
+    def __init__(self, fileobj, offset, length):
+        self._fileobj = fileobj
+        self._fd = fileobj.fileno()
+        self._offset = offset
+        self._remaining = length
+        os.lseek(self._fd, offset, os.SEEK_SET)
+
+    def subrange(self, start, length):
+        """Return a view of `length` bytes from `start` of this one."""
+        return _RangeFile(self._fileobj, self._offset + start, length)
+
+    def fileno(self):
+        return self._fd
+
+    def tell(self):
+        """Return the position in the underlying file."""
+        return os.lseek(self._fd, 0, os.SEEK_CUR)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = os.read(self._fd, size) if size else b''
+        self._remaining -= len(data)
+        return data
+
+    def peek(self, size=1):
+        pos = self.tell()
+        data = os.read(self._fd, min(max(size, 1), self._remaining))
+        os.lseek(self._fd, pos, os.SEEK_SET)
+        return data
+
+    def close(self):
+        self._fileobj.close()
+
+
+def _parse_range(header, size):
+    """Return the `(first, last)` byte positions requested by the Range
+    `header` for content of `size` bytes, or `None` if the header is
+    missing, not a single byte range, or not satisfiable."""
+    match = header and _RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if first:
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+    elif last:  # suffix range, the last bytes of the content
+        first = max(0, size - int(last))
+        last = size - 1
+    else:
+        return None
+    if first > last:
+        return None
+    return first, last
+
+
+def _open_stored(fileobj, zipinfo):
+    """Return a `_RangeFile` on the content of member `zipinfo` of the
+    archive file `fileobj`, or `None` if the member is compressed or
+    encrypted and has to be read through `ZipFile.open()`."""
+    if zipinfo.compress_type != ZIP_STORED or zipinfo.flag_bits & 0x1:
+        return None
+    fileobj.seek(zipinfo.header_offset)
+    header = fileobj.read(30)
+    if len(header) != 30 or header[:4] != b'PK\x03\x04':
+        return None
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    offset = zipinfo.header_offset + 30 + name_length + extra_length
+    return _RangeFile(fileobj, offset, zipinfo.file_size)
+
+
+class _ZipAttachment(Attachment):
+    """Attachment-like view of a file in a zipped attachment, for
+    rendering it with attachment.html."""
+
+    @property
+    def resource(self):
+        return Resource(self.parent_resource) \
+               .child(self.realm, self.filename)
+
+    def __init__(self, attachment, resource):
+        self.description = attachment.description
+        self.size = attachment.size
+        self.date = attachment.date
+        self.author = attachment.author
+        if hasattr(attachment, 'ipnr'):
+            self.ipnr = attachment.ipnr
+        self.filename = resource.id
+        self.parent_realm = resource.parent.realm
+        self.parent_id = resource.parent.id
+        self.parent_resource = resource.parent
+
+
 class ZipRenderer(Component):
     """Renderer for ZIP archive."""
-    implements(IResourceManager, IHTMLPreviewRenderer, IRequestHandler, IWikiSyntaxProvider, IRequestFilter, ITemplateProvider)
+    implements(IResourceManager, IHTMLPreviewRenderer, IRequestHandler, IWikiSyntaxProvider, IRequestFilter, ITemplateProvider,
+               IAttachmentChangeListener)
+
+    def __init__(self):
+        self._zip_index_cache = _LRUCache(
+            _INDEX_CACHE_SIZE, lambda index: len(index.infolist) + 1)
+        self._nested_cache = _LRUCache(_NESTED_CACHE_SIZE, len)
+        self._nested_locks = [Lock() for i in range(16)]
+        self._exists_cache = _LRUCache(1024)
+        self._prefetching = {}
+        self._prefetch_lock = Lock()
+        self._prefetch_slots = BoundedSemaphore(2)
+
+    # Options of other components; trac.ini changes reload the environment
+    @lazy
+    def max_preview_size(self):
+        return Mimeview(self.env).max_preview_size
+
+    @lazy
+    def render_unsafe(self):
+        return AttachmentModule(self.env).render_unsafe_content
+
+    def _open_zip(self, fileobj, key, title):
+        """Return a `ZipFile` reading the archive `title` in `fileobj`.
+
+        The central directory is cached under `key`: `_file_key()` of an
+        archive on disk (e.g. an attachment), extended by the member
+        names for archives nested in it. As the mtime and size are part
+        of the key, a replaced file is parsed again. If `key` is `None`
+        the archive is parsed on every call.
+
+        :raises ResourceNotFound: if `fileobj` is not a ZIP archive.
+        """
+        index = key and self._zip_index_cache.get(key)
+        if index is None and key:
+            # a prefetch of this archive may be parsing it right now
+            done = self._prefetching.get(key[0])
+            if done:
+                done.wait()
+                index = self._zip_index_cache.get(key)
+        if index is not None:
+            return _IndexedZipFile(fileobj, index)
+        try:
+            zipfile = ZipFile(fileobj)
+        except BadZipfile as e:
+            self.log.debug('ZIP fail: %s: %s' % (title, e))
+            raise ResourceNotFound(_("'%(title)s' is not a zip archive.",
+                                     title=title),
+                                   _('Invalid Zip'))
+        if key:
+            self._zip_index_cache.set(key, _zip_index(zipfile))
+        return zipfile
+
+    def _get_zip_index(self, fileobj, key, title):
+        """Return the `ZipIndex` of the archive `title` in `fileobj`,
+        cached under `key` (see `_open_zip()`)."""
+        return _zip_index(self._open_zip(fileobj, key, title))
+
+    def _spool_nested(self, entry, key, max_size):
+        """Return a seekable copy of the archive in `entry`.
+
+        Archives of up to 16 MiB nested in an archive on disk are kept
+        inflated under `key` (see `_open_zip()`) and shared between
+        requests; concurrent requests for the same one inflate it once.
+        """
+        if key is None or entry.zipinfo.file_size > _NESTED_ENTRY_SIZE:
+            return entry.spool(max_size)
+        with self._nested_locks[hash(key) % len(self._nested_locks)]:
+            data = self._nested_cache.get(key)
+            if data is None:
+                fileobj = entry.open()
+                try:
+                    data = fileobj.read()
+                finally:
+                    fileobj.close()
+                self._nested_cache.set(key, data)
+        return io.BytesIO(data)
+
+    def _prefetch_zip_index(self, path):
+        """Parse the central directory of the archive at `path` in a
+        background thread, so that the request reads it from the cache.
+
+        Nothing is done if it is cached already, if it is being
+        prefetched or if two prefetches are running; `_open_zip()` of
+        a file being prefetched waits for the prefetch to finish.
+        """
+        try:
+            st = os.stat(path)
+        except EnvironmentError:
+            return
+        if self._zip_index_cache.get((path, st.st_mtime, st.st_size)):
+            return
+        with self._prefetch_lock:
+            if path in self._prefetching:
+                return
+            if not self._prefetch_slots.acquire(False):
+                return
+            done = self._prefetching[path] = Event()
+
+        def prefetch():
+            try:
+                with open(path, 'rb') as fileobj:
+                    key = _file_key(fileobj)
+                    zipfile = ZipFile(fileobj)
+                    self._zip_index_cache.set(key, _zip_index(zipfile))
+            except Exception as e:
+                self.log.debug('ZIP prefetch failed: %s: %s' % (path, e))
+            finally:
+                with self._prefetch_lock:
+                    del self._prefetching[path]
+                done.set()
+                self._prefetch_slots.release()
+        thread = Thread(target=prefetch)
+        thread.daemon = True
+        thread.start()
 
     # IWikiSyntaxProvider methods
     def _format_link(self, formatter, ns, target, label):
         link, params, fragment = formatter.split_link(target)  # @UnusedVariable
-        ids = link.split(':', 2)
-        if len(ids) == 3:  # has a parent; filename!/path:realm:id
-            localid = ids[0]
-            parent_realm = ids[1]
-            ids = ids[2].split(':', 2)
-            if len(ids) == 3:
-                resource = Resource(ids[1], ids[2]).child(parent_realm, ids[0]).child('zip', localid)
-            elif len(ids) == 1:
-                resource = Resource(parent_realm, ids[0]).child('zip', localid)
+        match = _LINK_RE.match(link)
+        if match:  # has a parent; filename!/path:realm:id
+            localid, parent_realm, filename, realm, id_, parent_id = match.groups()
+            if filename is not None:  # ...:attachment:filename:realm:id
+                resource = Resource(realm, id_).child(parent_realm, filename).child('zip', localid)
             else:
-                resource = None
+                resource = Resource(parent_realm, parent_id).child('zip', localid)
             return tag.a(label,
                  href=get_resource_url(self.env, resource, formatter.href) + fragment)
         else:
@@ -75,10 +444,15 @@ class ZipRenderer(Component):
         if format_ in ['raw']:
             kwargs.pop('format')
             prefix = format_ + '-zip'
-        parent_href = unicode_unquote(get_resource_url(self.env,
-                            resource.parent(version=None), Href('')))
+        parent_href = self._archive_href(resource.parent)
         return href(prefix, "%s!/%s" % (parent_href, resource.id or ''), **kwargs)
 
+    def _archive_href(self, resource):
+        """Return the unquoted path of the archive `resource`, to which
+        `!/name` is appended for the files in it."""
+        return unicode_unquote(get_resource_url(self.env,
+                            resource(version=None), Href('')))
+
     def get_resource_description(self, resource, format=None, **kwargs):  # @ReservedAssignment
         if not resource.parent:
             return _("Unparented zip %(id)s", id=resource.id)
@@ -95,11 +469,53 @@ class ZipRenderer(Component):
                      parent=get_resource_name(self.env, resource.parent))
 
     def resource_exists(self, resource):
+        # wiki pages may link many entries of the same archive; remember
+        # the answer for a few seconds instead of querying each time;
+        # IAttachmentChangeListener methods drop it when it changes
+        parent = resource.parent
+        grandparent = parent.parent
+        # Attachment.parent_id is a string, ticket ids are not
+        key = (parent.realm, parent.id,
+               grandparent and grandparent.realm,
+               grandparent and to_unicode(grandparent.id))
+        now = time.time()
+        cached = self._exists_cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
         try:
-            attachment = Attachment(self.env, resource.parent)
-            return os.path.exists(attachment.path)
+            attachment = Attachment(self.env, parent)
+            exists = os.path.exists(attachment.path)
         except ResourceNotFound:
-            return False
+            exists = False
+        self._exists_cache.set(key, (now + 5, exists))
+        return exists
+
+    # IAttachmentChangeListener methods
+    def _forget_attachment(self, parent_realm, parent_id, filename):
+        self._exists_cache.pop(('attachment', filename, parent_realm,
+                                parent_id))
+
+    def attachment_added(self, attachment):
+        self._forget_attachment(attachment.parent_realm,
+                                attachment.parent_id, attachment.filename)
+
+    def attachment_deleted(self, attachment):
+        self._forget_attachment(attachment.parent_realm,
+                                attachment.parent_id, attachment.filename)
+
+    def attachment_moved(self, attachment, old_parent_realm, old_parent_id,
+                         old_filename):
+        self._forget_attachment(old_parent_realm, old_parent_id, old_filename)
+        self._forget_attachment(attachment.parent_realm,
+                                attachment.parent_id, attachment.filename)
+
+    def attachment_reparented(self, attachment, old_parent_realm,
+                              old_parent_id):
+        # Trac < 1.1.3
+        self._forget_attachment(old_parent_realm, old_parent_id,
+                                attachment.filename)
+        self._forget_attachment(attachment.parent_realm,
+                                attachment.parent_id, attachment.filename)
 
     # IHTMLPreviewRenderer methods
     def get_extra_mimetypes(self):
@@ -115,42 +531,57 @@ class ZipRenderer(Component):
         if content and content.input:
             f = content.input
             if not hasattr(f, 'seek'):
-                max_size = self.config.getint('mimeviewer', 'max_preview_size',
-                                              262144)
-                f = io.BytesIO(f.read(max_size))
-            zipfile = ZipFile(f)
-            listitems = []
-            for info in zipfile.infolist():
-                resource = context.resource.child('zip', info.filename)
-                href = get_resource_url(self.env, resource, context.href, rev=resource.parent.version)
-                raw_href = get_resource_url(self.env, resource, context.href, format='raw')
-                listitems.append(tag.li(
-                    tag.a(info.filename, href=href, title=_("View attachment")),
-                    tag.a(u'\u200B', href=raw_href, class_="trac-rawlink", title=_("Download")),
-                    " (%s)" % pretty_size(info.file_size)))
-            return tag.ul([listitems])
+                f = io.BytesIO(f.read(self.max_preview_size))
+            if context.resource.realm == 'attachment':
+                key = _file_key(f)
+            else:
+                key = None
+            # same urls as get_resource_url() of the entries, but the
+            # archive part is only computed once
+            ctx_href = context.href
+            archive_href = self._archive_href(context.resource)
+            rev = context.resource.version
+            view_title = _("View attachment")
+            download_title = _("Download")
+
+            def listitem(info):
+                path = "%s!/%s" % (archive_href, info.filename)
+                href = ctx_href('zip', path, rev=rev)
+                raw_href = ctx_href('raw-zip', path)
+                return tag.li(
+                    tag.a(info.filename, href=href, title=view_title),
+                    tag.a(u'\u200B', href=raw_href, class_="trac-rawlink", title=download_title),
+                    " (%s)" % pretty_size(info.file_size))
+            index = self._get_zip_index(f, key,
+                                        filename or context.resource.id)
+            return tag.ul(listitem(info) for info in index.infolist
+                          if not info.filename.endswith('/'))
 
     # IRequestHandler methods
     def match_request(self, req):
-        match = re.match(r'/(raw-)?zip(?:/zip)*/attachment/([^/]+)/([^!]*)/([^/!]+)(!/.+)?(@.+)?$', req.path_info)
+        if not req.path_info.startswith(('/zip', '/raw-zip')):
+            return False
+        match = _ATTACHMENT_RE.match(req.path_info)
         # I know that attachment cannot have revision ... it's junk code
         if match:
             req.args['format'], realm, resource_id, archive, req.args['path'], rev = match.groups()
             req.args['attachment'] = Resource(realm, resource_id).child('attachment', archive)
+            req.args['_zip_parsed'] = _parsed_path(req.args, realm, archive)
             if rev:
                 req.args['rev'] = rev[1:]
             return True
-        match = re.match(r'/(raw-)?zip(?:/zip)*/(export|browser|file)/([^!]+)(!/[^@]+)?(@.+)?$', req.path_info)
+        match = _BROWSER_RE.match(req.path_info)
         if match:
             req.args['format'], realm, resource_id, req.args['path'], rev = match.groups()
             req.args['browser'] = Resource(realm, resource_id)
+            req.args['_zip_parsed'] = _parsed_path(req.args, realm, resource_id)
             if rev:
                 req.args['rev'] = rev[1:]
             return True
         pass
 
     def process_request(self, req):
-        max_size = self.env.config.getint('mimeviewer', 'max_preview_size', default=262144)
+        max_size = self.max_preview_size
         attachment = req.args.get('attachment', None)
         browser = req.args.get('browser', None)
         resource = attachment or browser
@@ -181,6 +612,9 @@ class ZipRenderer(Component):
                     raise ResourceNotFound(e.message,
                                            _('Invalid changeset number'))
             fileobj = node.get_content()
+            if not hasattr(fileobj, 'seek'):
+                # ZipFile seeks around; read the stream once in large blocks
+                fileobj = _spool(fileobj, node.content_length, max_size)
         else:
             raise TracError('Not Implemented')
 
@@ -189,24 +623,40 @@ class ZipRenderer(Component):
 
         self.log.info('ZIP: %s' % attachment.resource.id)
 
+        # only attachments are files of their own; repository content
+        # may be a spooled temporary file
+        archive_key = key = _file_key(fileobj) if attachment else None
+        zipfile = self._open_zip(fileobj, key, resource.id)
         if name:
-            for element in [e.lstrip('/') for e in name.split('!')]:
+            elements = req.args['_zip_parsed']['segments']
+            for depth, element in enumerate(elements, 1):
                 self.log.debug('ZIP element: %s' % element)
-                zipfile = ZipFile(fileobj)
                 try:
-                    fileobj = zipfile.open(element)
+                    entry = _LazyZipEntry(zipfile, zipfile.NameToInfo[element])
                 except KeyError:
                     self.log.debug('ZIP fail: %s' % element)
                     raise ResourceNotFound(_("Attchment '%(title)s' does not exist.",  # FIXME: in browser, wrong message
                          title=name),
                        _('Invalid filename in Zip'))
+                if depth < len(elements) or xhr:
+                    # archive to traverse or to list; ZipFile needs to seek in it
+                    key = key and key + (element,)
+                    zipfile = self._open_zip(
+                        self._spool_nested(entry, key, max_size), key, element)
+            zipinfo = entry.zipinfo
+            if xhr:
+                pass
+            elif depth == 1 and archive_key:
+                # member of an archive on disk; stored ones need no inflating
+                fileobj = _open_stored(fileobj, zipinfo) or entry.open()
+            else:
+                fileobj = entry.open()
             context = web_context(req, resource.child('zip', name, version=rev))
         else:
             context = web_context(req)
 
         if xhr:
             self.log.debug('ZIP xhr')
-            zipfile = ZipFile(fileobj)
             data = {
                 'reponame': reponame, 'stickyrev': node.created_rev,
                 'display_rev': lambda x: x,
@@ -226,29 +676,22 @@ class ZipRenderer(Component):
             #hilbix: This return probably is no more correct?
             return 'dir_entries.html', data
 
-        try:
-            self.log.debug('ZIP info: %s' % element)
-            zipinfo = zipfile.getinfo(element)
-        except KeyError:
-            self.log.debug('ZIP fail: %s' % element)
-            raise ResourceNotFound(_("Attchment '%(title)s' does not exist.",  # FIXME: in browser, wrong message
-                         title=name),
-                       _('Invalid filename in Zip'))
-
         self.log.debug('HERE %s' % zipinfo)
 
         str_data = fileobj.peek(512)
         mimeview = Mimeview(self.env)
         mime_type = mimeview.get_mimetype(name, str_data)
-        if mime_type and 'charset=' not in mime_type:
+        if mime_type and is_binary(str_data):
+            # get_mimetype() adds a charset even to binary content
+            mime_type = mime_type.split(';', 1)[0]
+        elif mime_type and 'charset=' not in mime_type:
             charset = mimeview.get_charset(str_data, mime_type)
             mime_type = mime_type + '; charset=' + charset
 
         self.log.debug('ZIP mimetype: %s' % mime_type)
 
         if req.args['format'] != 'raw-':  # format != raw
-            href = unicode_unquote(get_resource_url(self.env, resource, Href('')))
-            href += '!/' + name
+            href = self._archive_href(resource) + '!/' + name
             rawurl = req.href('raw-zip', href, rev=rev)
             add_stylesheet(req, 'common/css/code.css')
             add_link(req, 'alternate', rawurl, _('Original Format'), mime_type)
@@ -258,26 +701,6 @@ class ZipRenderer(Component):
                  annotations=['lineno'])
 
             if attachment:
-
-                class _ZipAttachment(Attachment):
-
-                    @property
-                    def resource(self):
-                        return Resource(self.parent_resource) \
-                               .child(self.realm, self.filename)
-
-                    def __init__(self, attachment, resource):
-                        self.description = attachment.description
-                        self.size = attachment.size
-                        self.date = attachment.date
-                        self.author = attachment.author
-                        if hasattr(attachment, 'ipnr'):
-                            self.ipnr = attachment.ipnr
-                        self.filename = resource.id
-                        self.parent_realm = resource.parent.realm
-                        self.parent_id = resource.parent.id
-                        self.parent_resource = resource.parent
-
                 #hilbix: This does not work, but I currently do not know how to fix it, sorry!
                 attachment = _ZipAttachment(attachment, context.resource)
 
@@ -327,16 +750,34 @@ class ZipRenderer(Component):
             #hilbix: Untested, probably works
         else:
             #hilbix: Tested, works
-            req.send_response(200)
-            if not self.env.config.getbool('attachment', 'render_unsafe_content'):
+            length = zipinfo.file_size
+            # only stored members of an archive on disk can seek cheaply,
+            # Range headers are ignored for everything else
+            seekable = isinstance(fileobj, _RangeFile)
+            span = seekable and _parse_range(req.get_header('Range'), length)
+            if_range = req.get_header('If-Range')
+            if if_range and if_range != last_modified:
+                span = None  # changed since; the whole content is sent
+            if span:
+                first, last = span
+                fileobj = fileobj.subrange(first, last - first + 1)
+                req.send_response(206)
+                req.send_header('Content-Range',
+                                'bytes %d-%d/%d' % (first, last, length))
+                length = last - first + 1
+            else:
+                req.send_response(200)
+            if seekable:
+                req.send_header('Accept-Ranges', 'bytes')
+            if not self.render_unsafe:
                 req.send_header('Content-Disposition', 'attachment')
             if mime_type:
                 req.send_header('Content-Type', mime_type)
-            req.send_header('Content-Length', zipinfo.file_size)
+            req.send_header('Content-Length', length)
             req.send_header('Last-Modified', last_modified)
             req.end_headers()
             file_wrapper = req.environ.get('wsgi.file_wrapper', _FileWrapper)
-            req._response = file_wrapper(fileobj, 4096)
+            req._response = file_wrapper(fileobj, _BUFSIZE)
         raise RequestDone
 
     # ITemplateProvider methods
@@ -349,6 +790,14 @@ class ZipRenderer(Component):
 
     # IRequestFilter methods
     def pre_process_request(self, req, handler):
+        attachment = handler is self and req.args.get('attachment')
+        if attachment and 'ATTACHMENT_VIEW' in req.perm(attachment):
+            # match_request() has parsed the attachment; warm the cache
+            # while the request is still being set up
+            parent = attachment.parent
+            self._prefetch_zip_index(Attachment._get_path(
+                self.env.attachments_dir, parent.realm, parent.id,
+                attachment.id))
         return handler
 
     def post_process_request(self, req, template, data, content_type):